@@ -1,3 +1,274 @@
+import datetime
+import hashlib
+import io
+import pathlib
+import tempfile
+
+import folium
+import folium.plugins
+import numexpr
+import numpy
+import pandas
+import plotly.express
+import pyarrow
+import pyarrow.csv
+import streamlit
+from streamlit_folium import st_folium
+
+# Only these columns are ever read downstream; skipping the rest keeps
+# parsing and memory proportional to what the app actually uses.
+STATION_COLUMNS = {"MonitoringLocationIdentifier", "MonitoringLocationName", "LatitudeMeasure", "LongitudeMeasure"}
+RESULTS_COLUMNS = {"CharacteristicName", "ResultMeasureValue", "ActivityStartDate", "MonitoringLocationIdentifier"}
+
+# Dictionary-encoded columns come back from Arrow as pandas category dtype.
+STATION_TYPES = {
+    "LatitudeMeasure": pyarrow.float64(),
+    "LongitudeMeasure": pyarrow.float64(),
+    "MonitoringLocationIdentifier": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+    "MonitoringLocationName": pyarrow.string(),
+}
+RESULTS_TYPES = {
+    "CharacteristicName": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+    "MonitoringLocationIdentifier": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+    "ActivityStartDate": pyarrow.timestamp("ns"),
+    # Kept as string; coerced with to_numeric below so "<0.5" becomes NaN.
+    "ResultMeasureValue": pyarrow.string(),
+}
+
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(String(row[2]));
+    return marker;
+}
+"""
+
+# On-disk cache of cleaned frames; unlike st.cache_data it survives server
+# restarts, so re-uploading the same file never re-parses the CSV.
+CACHE_DIR = pathlib.Path(tempfile.gettempdir()) / "contaminant-explorer-cache"
+
+
+def parquet_cache_path(*parts):
+    """Content-addressed Parquet path for a cleaned frame.
+
+    blake2b hashes at GB/s, a rounding error next to the parse it lets us
+    skip.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+    return CACHE_DIR / f"{digest.hexdigest()}.parquet"
+
+
+def read_parquet_cache(cache_path):
+    """Load a previously cleaned frame, or None on a cache miss."""
+    if cache_path.exists():
+        return pandas.read_parquet(cache_path, engine="pyarrow")
+    return None
+
+
+def write_parquet_cache(frame, cache_path):
+    """Persist a cleaned frame; written to a temp file then renamed so a
+    crashed write never leaves a half-finished cache entry behind."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    frame.to_parquet(tmp_path, engine="pyarrow", compression="zstd")
+    tmp_path.replace(cache_path)
+
+
+def present_columns(data, wanted_columns):
+    """Header-only sniff of which of the wanted columns the file actually has."""
+    header = pandas.read_csv(io.BytesIO(data), nrows=0).columns
+    return [name for name in header if name in wanted_columns]
+
+
+def read_csv_arrow(data, wanted_columns, column_types):
+    """Parse CSV bytes with PyArrow's multi-threaded reader.
+
+    Arrow scans delimiters with SIMD and parses column chunks in parallel,
+    then hands the buffers to pandas without a second conversion pass.
+    Only the columns the app uses (and that the file actually has) are read.
+    """
+    table = pyarrow.csv.read_csv(
+        io.BytesIO(data),
+        read_options=pyarrow.csv.ReadOptions(use_threads=True),
+        convert_options=pyarrow.csv.ConvertOptions(
+            include_columns=present_columns(data, wanted_columns),
+            column_types=column_types,
+        ),
+    )
+    return table.to_pandas()
+
+
+def iter_result_batches(results_bytes):
+    """Yield the results CSV as DataFrame batches without loading it whole."""
+    reader = pyarrow.csv.open_csv(
+        io.BytesIO(results_bytes),
+        read_options=pyarrow.csv.ReadOptions(use_threads=True),
+        convert_options=pyarrow.csv.ConvertOptions(
+            include_columns=present_columns(results_bytes, RESULTS_COLUMNS),
+            column_types=RESULTS_TYPES,
+        ),
+    )
+    for batch in reader:
+        yield batch.to_pandas()
+
+
+@streamlit.cache_data(show_spinner=False)
+def load_station(station_bytes):
+    """Parse and clean the station CSV, cached on the raw file bytes."""
+    cache_path = parquet_cache_path(b"station", station_bytes)
+    cached = read_parquet_cache(cache_path)
+    if cached is not None:
+        return cached
+
+    station_df = read_csv_arrow(station_bytes, STATION_COLUMNS, STATION_TYPES)
+
+    # Drop rows with missing coordinates
+    if "LatitudeMeasure" in station_df.columns and "LongitudeMeasure" in station_df.columns:
+        station_df = station_df.dropna(subset=["LatitudeMeasure", "LongitudeMeasure"])
+
+    # Ensure station identifier exists; fall back to the station name if needed
+    if "MonitoringLocationIdentifier" not in station_df.columns and "MonitoringLocationName" in station_df.columns:
+        station_df["MonitoringLocationIdentifier"] = station_df["MonitoringLocationName"]
+    if "MonitoringLocationIdentifier" in station_df.columns:
+        # category dtype: isin/== then compare small integer codes, not strings
+        station_df["MonitoringLocationIdentifier"] = station_df["MonitoringLocationIdentifier"].astype("category")
+
+    write_parquet_cache(station_df, cache_path)
+    return station_df
+
+
+@streamlit.cache_data(show_spinner=False)
+def scan_results_metadata(results_bytes):
+    """One streaming pass over the results CSV collecting widget bounds.
+
+    Gathers the contaminant list and the global measurement/date ranges
+    without ever holding more than one record batch in memory.
+    """
+    columns = present_columns(results_bytes, RESULTS_COLUMNS)
+    contaminants = set()
+    min_value = max_value = None
+    min_date = max_date = None
+    for batch_df in iter_result_batches(results_bytes):
+        if "CharacteristicName" in batch_df.columns:
+            contaminants.update(batch_df["CharacteristicName"].cat.categories)
+        if "ResultMeasureValue" in batch_df.columns:
+            values = pandas.to_numeric(batch_df["ResultMeasureValue"], errors="coerce")
+            low, high = values.min(), values.max()
+            if pandas.notna(low):
+                min_value = float(low) if min_value is None else min(min_value, float(low))
+                max_value = float(high) if max_value is None else max(max_value, float(high))
+        if "ActivityStartDate" in batch_df.columns:
+            early, late = batch_df["ActivityStartDate"].min(), batch_df["ActivityStartDate"].max()
+            if pandas.notna(early):
+                min_date = early if min_date is None else min(min_date, early)
+                max_date = late if max_date is None else max(max_date, late)
+    return {
+        "columns": columns,
+        "contaminants": sorted(contaminants),
+        "min_value": min_value,
+        "max_value": max_value,
+        "min_date": min_date,
+        "max_date": max_date,
+    }
+
+
+@streamlit.cache_data(show_spinner=False, max_entries=8)
+def load_filtered_results(results_bytes, contaminant):
+    """Stream the results CSV and keep only the selected contaminant's rows.
+
+    Peak memory is one record batch plus the surviving rows, so a results
+    file far larger than RAM still loads. Cached per (file, contaminant)
+    pair; max_entries bounds how many contaminant subsets stay resident.
+    """
+    cache_path = parquet_cache_path(b"results", results_bytes, contaminant)
+    cached = read_parquet_cache(cache_path)
+    if cached is not None:
+        return cached
+
+    chunks = []
+    for batch_df in iter_result_batches(results_bytes):
+        chunks.append(batch_df[batch_df["CharacteristicName"] == contaminant])
+    if chunks:
+        filtered = pandas.concat(chunks)
+    else:
+        filtered = pandas.DataFrame(
+            {
+                "CharacteristicName": pandas.Series(dtype="category"),
+                "ResultMeasureValue": pandas.Series(dtype="float64"),
+                "ActivityStartDate": pandas.Series(dtype="datetime64[ns]"),
+                "MonitoringLocationIdentifier": pandas.Series(dtype="category"),
+            }
+        )
+
+    # ResultMeasureValue regularly carries non-numeric entries ("<0.5", "ND"),
+    # so it is the one column still coerced after the parse.
+    filtered["ResultMeasureValue"] = pandas.to_numeric(filtered["ResultMeasureValue"], errors="coerce")
+    # Concatenating per-batch dictionaries decays to object; re-encode once
+    # over the (small) surviving rows.
+    filtered["MonitoringLocationIdentifier"] = filtered["MonitoringLocationIdentifier"].astype("category")
+    write_parquet_cache(filtered, cache_path)
+    return filtered
+
+
+def monthly_station_means(station_codes, station_labels, dates, values):
+    """Per-station monthly averages in one pass over sorted arrays.
+
+    Sorting by (station, month) makes every group a contiguous run, so the
+    group sums fall out of a single np.add.reduceat over the value buffer
+    instead of a pandas groupby with per-group dispatch. Returns a long
+    frame with Month / Station / Value columns ready for plotting.
+    """
+    valid = station_codes >= 0
+    if not valid.all():
+        station_codes = station_codes[valid]
+        dates = dates[valid]
+        values = values[valid]
+    if not len(values):
+        return pandas.DataFrame({"Month": [], "Station": [], "Value": []})
+
+    month_i8 = dates.astype("datetime64[M]").view("i8")
+    order = numpy.lexsort((month_i8, station_codes))
+    codes_sorted = station_codes[order]
+    months_sorted = month_i8[order]
+    values_sorted = values[order]
+
+    # Months since the epoch fit easily in 32 bits, so (code, month) packs
+    # into one int64 key per row.
+    keys = (codes_sorted.astype(numpy.int64) << 32) | (months_sorted & 0xFFFFFFFF)
+    change = numpy.empty(len(keys), dtype=bool)
+    change[0] = True
+    numpy.not_equal(keys[1:], keys[:-1], out=change[1:])
+    starts = numpy.flatnonzero(change)
+
+    sums = numpy.add.reduceat(values_sorted, starts)
+    counts = numpy.diff(numpy.append(starts, len(values_sorted)))
+    return pandas.DataFrame(
+        {
+            "Month": months_sorted[starts].view("datetime64[M]").astype("datetime64[ns]"),
+            "Station": station_labels[codes_sorted[starts]],
+            "Value": sums / counts,
+        }
+    )
+
+
+@streamlit.cache_resource(show_spinner=False)
+def build_map(ids_tuple, coords_bytes):
+    """Build the station map once per distinct station set.
+
+    Keyed on the station identifiers and the packed coordinate bytes, so
+    reruns that leave the station subset unchanged (e.g. narrowing a date
+    range within the same membership) skip the map construction and HTML
+    serialization entirely.
+    """
+    coords = numpy.frombuffer(coords_bytes, dtype="float64").reshape(-1, 2)
+    avg_lat, avg_lon = coords.mean(axis=0)
+    m = folium.Map(location=[avg_lat, avg_lon], zoom_start=8)
+    marker_data = [[lat, lon, ident] for (lat, lon), ident in zip(coords, ids_tuple)]
+    folium.plugins.FastMarkerCluster(marker_data, callback=MARKER_CALLBACK).add_to(m)
+    return m
+
 
 streamlit.title("Contaminant Explorer App")
 
@@ -17,129 +288,146 @@ results_file = streamlit.sidebar.file_uploader("Upload Test Results Database (CS
 
 if station_file is not None and results_file is not None:
     try:
-        station_df = pandas.read_csv(station_file)
-        results_df = pandas.read_csv(results_file)
+        station_df = load_station(station_file.getvalue())
+        # A cache_data lookup still re-hashes the raw upload bytes on every
+        # rerun; stashing the scan result in session_state keyed by the
+        # upload id makes reruns a plain dict read.
+        if streamlit.session_state.get("results_meta_for") != results_file.file_id:
+            streamlit.session_state["results_meta"] = scan_results_metadata(results_file.getvalue())
+            streamlit.session_state["results_meta_for"] = results_file.file_id
+        results_meta = streamlit.session_state["results_meta"]
     except Exception as e:
         streamlit.error(f"Error reading files: {e}")
         streamlit.stop()
 
-    # Ensure latitude and longitude are numeric and drop rows with missing coordinates
-    if "LatitudeMeasure" in station_df.columns and "LongitudeMeasure" in station_df.columns:
-        station_df["LatitudeMeasure"] = pandas.to_numeric(station_df["LatitudeMeasure"], errors="coerce")
-        station_df["LongitudeMeasure"] = pandas.to_numeric(station_df["LongitudeMeasure"], errors="coerce")
-        station_df = station_df.dropna(subset=["LatitudeMeasure", "LongitudeMeasure"])
-    else:
+    if "LatitudeMeasure" not in station_df.columns or "LongitudeMeasure" not in station_df.columns:
         streamlit.error("Station database must include 'LatitudeMeasure' and 'LongitudeMeasure'.")
         streamlit.stop()
 
-    # Ensure station identifier exists
     if "MonitoringLocationIdentifier" not in station_df.columns:
-        # If not present, use "MonitoringLocationName" as the identifier
-        if "MonitoringLocationName" in station_df.columns:
-            station_df["MonitoringLocationIdentifier"] = station_df["MonitoringLocationName"].astype(str)
-        else:
-            streamlit.error("Station database must contain 'MonitoringLocationIdentifier' or 'MonitoringLocationName'.")
-            streamlit.stop()
-    else:
-        station_df["MonitoringLocationIdentifier"] = station_df["MonitoringLocationIdentifier"].astype(str)
+        streamlit.error("Station database must contain 'MonitoringLocationIdentifier' or 'MonitoringLocationName'.")
+        streamlit.stop()
 
-    # Convert ActivityStartDate to datetime in results_df
-    if 'ActivityStartDate' in results_df.columns:
-        results_df['ActivityStartDate'] = pd.to_datetime(results_df['ActivityStartDate'], errors='coerce')
-    else:
+    results_columns = results_meta["columns"]
+    if "ActivityStartDate" not in results_columns:
         streamlit.error("Test results database must contain 'ActivityStartDate'.")
         streamlit.stop()
 
-    # Ensure test results have a station identifier column
-    if "MonitoringLocationIdentifier" not in results_df.columns:
+    if "MonitoringLocationIdentifier" not in results_columns:
         streamlit.error("Test results database must contain 'MonitoringLocationIdentifier'.")
-        st.stop()
-    else:
-        results_df["MonitoringLocationIdentifier"] = results_df["MonitoringLocationIdentifier"].astype(str)
+        streamlit.stop()
 
     streamlit.sidebar.header("2. Select Contaminant and Filters")
-    if "CharacteristicName" not in results_df.columns:
+    if "CharacteristicName" not in results_columns:
         streamlit.error("Test results database must contain 'CharacteristicName'.")
         streamlit.stop()
-    unique_contaminants = sorted(results_df["CharacteristicName"].dropna().unique())
-    contaminant = streamlit.sidebar.selectbox("Select Contaminant", unique_contaminants)
-
-    # Filter test results for the selected contaminant (case-insensitive)
-    filtered_results = results_df[results_df["CharacteristicName"].str.contains(contaminant, case=False, na=False)].copy()
-
-    if "ResultMeasureValue" not in filtered_results.columns:
+    if "ResultMeasureValue" not in results_columns:
         streamlit.error("Test results database must contain 'ResultMeasureValue'.")
         streamlit.stop()
-    filtered_results["ResultMeasureValue"] = pandas.to_numeric(filtered_results["ResultMeasureValue"], errors="coerce")
-    filtered_results = filtered_results.dropna(subset=["ResultMeasureValue"])
+    unique_contaminants = results_meta["contaminants"]
 
-    # Set up measurement range slider
-    if not filtered_results.empty:
-        min_val = float(filtered_results["ResultMeasureValue"].min())
-        max_val = float(filtered_results["ResultMeasureValue"].max())
+    # Widget bounds come from the global ranges gathered during the metadata
+    # scan, so they don't depend on the per-contaminant load.
+    if results_meta["min_value"] is not None:
+        min_val = results_meta["min_value"]
+        max_val = results_meta["max_value"]
     else:
-        min_val, max_val = 0, 1
-
-    meas_range = streamlit.sidebar.slider("Select Measurement Range", min_value=min_val, max_value=max_val, 
-                                    value=(min_val, max_val))
-
-    # Set up date range filter
-    filtered_results = filtered_results.dropna(subset=["ActivityStartDate"])
-    if not filtered_results.empty:
-        min_date = filtered_results["ActivityStartDate"].min().date()
-        max_date = filtered_results["ActivityStartDate"].max().date()
+        min_val, max_val = 0.0, 1.0
+    if results_meta["min_date"] is not None:
+        min_date = results_meta["min_date"].date()
+        max_date = results_meta["max_date"].date()
     else:
         min_date = datetime.date.today()
         max_date = datetime.date.today()
-    date_range = streamlit.sidebar.date_input("Select Date Range", value=(min_date, max_date))
 
-    filtered_results = filtered_results[
-        (filtered_results["ResultMeasureValue"] >= meas_range[0]) &
-        (filtered_results["ResultMeasureValue"] <= meas_range[1]) &
-        (filtered_results["ActivityStartDate"].between(pandas.to_datetime(date_range[0]), pandas.to_datetime(date_range[1])))
-    ]
+    # A form batches the filter inputs: dragging the slider or stepping
+    # through dates no longer reruns the whole pipeline -- only pressing
+    # Apply does.
+    with streamlit.sidebar.form("filters"):
+        contaminant = streamlit.selectbox("Select Contaminant", unique_contaminants)
+        meas_range = streamlit.slider("Select Measurement Range", min_value=min_val, max_value=max_val,
+                                      value=(min_val, max_val))
+        date_range = streamlit.date_input("Select Date Range", value=(min_date, max_date))
+        submitted = streamlit.form_submit_button("Apply")
 
-    # Get selected station identifiers from filtered test results
-    selected_stations = filtered_results["MonitoringLocationIdentifier"].unique()
-    streamlit.write("Selected Station Identifiers:", selected_stations)
+    if submitted:
+        streamlit.session_state["filters_applied"] = True
+    if not streamlit.session_state.get("filters_applied"):
+        streamlit.write("Choose your filters and press Apply to run the analysis.")
+        streamlit.stop()
+
+    # Stream-load just this contaminant's rows; the full results table is
+    # never held in memory at once.
+    filtered_results = load_filtered_results(results_file.getvalue(), contaminant)
+
+    # Apply the measurement and date ranges in a single fused pass. numexpr
+    # walks the arrays in cache-sized blocks and writes one boolean output,
+    # instead of allocating five full-length temporaries for the chained &s.
+    # The compares also subsume the old dropna pre-passes: NaN values fail
+    # vals >= lo, and NaT views as INT64_MIN so it fails dates >= d0.
+    vals = filtered_results["ResultMeasureValue"].to_numpy()
+    dates = filtered_results["ActivityStartDate"].to_numpy().view("i8")
+    lo, hi = meas_range
+    d0 = numpy.datetime64(date_range[0], "ns").view("i8")
+    d1 = numpy.datetime64(date_range[1], "ns").view("i8")
+    range_mask = numexpr.evaluate("(vals >= lo) & (vals <= hi) & (dates >= d0) & (dates <= d1)")
+    filtered_results = filtered_results[range_mask]
+
+    # Get selected station identifiers from filtered test results. np.unique
+    # over the small integer category codes replaces a hash of every row's
+    # string; only the few distinct ids are boxed back to strings.
+    result_codes = numpy.unique(filtered_results["MonitoringLocationIdentifier"].cat.codes.to_numpy())
+    result_codes = result_codes[result_codes >= 0]
+    selected_stations = filtered_results["MonitoringLocationIdentifier"].cat.categories.to_numpy()[result_codes]
 
-    # Filter station database based on selected station identifiers
-    station_subset = station_df[station_df["MonitoringLocationIdentifier"].isin(selected_stations)]
-    streamlit.write("Station Subset for Map:", station_subset)
+    # Filter station database based on selected station identifiers. Mapping
+    # the few selected ids into the station dictionary keeps the row-level
+    # work an isin over packed integer codes -- no string hashing.
+    station_categories = station_df["MonitoringLocationIdentifier"].cat.categories
+    selected_codes = station_categories.get_indexer(selected_stations)
+    selected_codes = selected_codes[selected_codes >= 0]
+    station_codes = station_df["MonitoringLocationIdentifier"].cat.codes.to_numpy()
+    station_subset = station_df[numpy.isin(station_codes, selected_codes)]
+
+    # Serializing thousands of ids/rows to the browser on every rerun costs
+    # more than the filtering itself; keep the debug view collapsed and
+    # bounded.
+    with streamlit.expander("Debug: selected stations"):
+        streamlit.write("Selected Station Identifiers (first 50):", selected_stations[:50])
+        streamlit.write("Station Subset for Map (first 50):", station_subset.head(50))
 
     streamlit.header("Map of Stations with Selected Contaminant")
     if not station_subset.empty:
-        avg_lat = station_subset["LatitudeMeasure"].mean()
-        avg_lon = station_subset["LongitudeMeasure"].mean()
-        m = folium.Map(location=[avg_lat, avg_lon], zoom_start=8)
-        for _, row in station_subset.iterrows():
-            folium.Marker(
-                location=[row["LatitudeMeasure"], row["LongitudeMeasure"]],
-                popup=row["MonitoringLocationIdentifier"]
-            ).add_to(m)
-        streamlit_folium(m, width=700, height=500)
+        ids_tuple = tuple(station_subset["MonitoringLocationIdentifier"])
+        coords_bytes = station_subset[["LatitudeMeasure", "LongitudeMeasure"]].to_numpy(dtype="float64").tobytes()
+        m = build_map(ids_tuple, coords_bytes)
+        st_folium(m, width=700, height=500)
     else:
         streamlit.write("No stations found for the selected criteria.")
 
     streamlit.header(f"Trend Over Time for {contaminant}")
     if not filtered_results.empty:
-        filtered_results["Month"] = filtered_results["ActivityStartDate"].dt.to_period("M")
-        trend_df = filtered_results.groupby(["MonitoringLocationIdentifier", "Month"])["ResultMeasureValue"].mean().reset_index()
-        trend_df["Month"] = trend_df["Month"].dt.to_timestamp()
-        matplotlib.figure(figsize=(12, 8))
-        for station in trend_df["MonitoringLocationIdentifier"].unique():
-            station_data = trend_df[trend_df["MonitoringLocationIdentifier"] == station].sort_values("Month")
-            matplotlib.plot(station_data["Month"], station_data["ResultMeasureValue"], marker="o", linestyle="-", label=station)
-        matplotlib.xlabel("Time")
-        matplotlib.ylabel("Measurement Value")
-        matplotlib.title(f"Trend of {contaminant} Over Time")
-        matplotlib.legend(title="Station", bbox_to_anchor=(1.05, 1), loc="upper left")
-        streamlit.pyplot(matplotlib)
+        trend = monthly_station_means(
+            filtered_results["MonitoringLocationIdentifier"].cat.codes.to_numpy(),
+            filtered_results["MonitoringLocationIdentifier"].cat.categories.to_numpy(),
+            filtered_results["ActivityStartDate"].to_numpy(),
+            filtered_results["ResultMeasureValue"].to_numpy(),
+        )
+        # Plotly ships the trend data to the browser once and renders there,
+        # instead of encoding a fresh PNG server-side on every rerun (which
+        # also leaked pyplot figure state across reruns).
+        fig = plotly.express.line(
+            trend,
+            x="Month",
+            y="Value",
+            color="Station",
+            markers=True,
+            labels={"Month": "Time", "Value": "Measurement Value"},
+            title=f"Trend of {contaminant} Over Time",
+        )
+        streamlit.plotly_chart(fig, use_container_width=True)
     else:
         streamlit.write("No measurements found for the selected criteria.")
 
 else:
     streamlit.write("Please upload both the station and test results databases.")
-
-
-